@@ -6,11 +6,226 @@ either from a provided centroid list or from the file's own centroids.
 """
 
 import argparse
+import json
+import os
 import sys
+import tempfile
+import threading
+import warnings
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import partial
 from pathlib import Path
 import numpy as np
 import SimpleITK as sitk
-import m2aia as m2
+
+
+# m2aia's ImzMLReader returns corrupted ion images when it is queried from
+# several threads at once, so every worker thread opens its own reader.
+# Opening readers concurrently can crash MITK's resource loading, so the
+# readers are created one at a time. Loading a reader reads the whole file
+# once, so the reader of the main thread is handed to the first worker, and
+# an extra reader is only opened per _IMAGES_PER_READER ion images (one load
+# takes about as long as extracting ~80 ion images).
+_worker_state = threading.local()
+_reader_lock = threading.Lock()
+_IMAGES_PER_READER = 100
+
+
+def _plan_workers(max_workers, n_images):
+    """Number of extraction workers for n_images ion images, one per _IMAGES_PER_READER images."""
+    return max(1, min(max_workers, -(-n_images // _IMAGES_PER_READER)))
+
+
+def _init_worker(imzml_path, tolerance, spare_readers, extraction_done):
+    """
+    Take a reader from spare_readers or open a new one for this thread of the extraction pool.
+    No reader is opened anymore once extraction_done is set, as no ion images are left.
+    """
+    import m2aia as m2
+    
+    with _reader_lock:
+        if spare_readers:
+            _worker_state.img = spare_readers.pop()
+        elif extraction_done.is_set():
+            return
+        else:
+            _worker_state.img = m2.ImzMLReader(imzml_path)
+    _worker_state.img.SetTolerance(tolerance)
+
+
+def _extract_ion_image(mz, tolerance):
+    """Extract the ion image for a single m/z value in a worker thread."""
+    # Get the ion image for this m/z value (returns SimpleITK image)
+    sitk_image = _worker_state.img.GetImage(mz, tolerance)
+    
+    # m2aia already returns float32 images, only cast other pixel types
+    if sitk_image.GetPixelID() != sitk.sitkFloat32:
+        sitk_image = sitk.Cast(sitk_image, sitk.sitkFloat32)
+    return sitk_image
+
+
+def _extract_ion_array(mz, tolerance):
+    """Extract the ion image for a single m/z value as numpy array, skipping SimpleITK."""
+    return _worker_state.img.GetArray(mz, tolerance, dtype=np.float32)
+
+
+def _completed_in_window(executor, fn, items, max_pending):
+    """
+    Submit fn(item) for every item, keeping at most max_pending tasks in flight,
+    and yield (index, future) pairs in order of completion.
+    """
+    items = iter(enumerate(items))
+    pending = {}
+    
+    def submit_next():
+        entry = next(items, None)
+        if entry is not None:
+            index, item = entry
+            pending[executor.submit(fn, item)] = index
+    
+    for _ in range(max_pending):
+        submit_next()
+    
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            # Refill the window before handing out the result to keep the workers busy
+            index = pending.pop(future)
+            submit_next()
+            yield index, future
+
+
+def _batch_ion_images(img, unique_centroids, feature_rows, tolerance, data_matrix,
+                      batch_bytes=64 * 1024**2):
+    """
+    Fill the feature_rows of data_matrix [n_features, height, width] with the ion images
+    of the sorted unique_centroids in a single pass over the spectra of a continuous imzML file.
+    Mirrors ImzMLReader.GetArray: maximum intensity within [mz - tol, mz + tol], 0 if empty.
+    """
+    if len(unique_centroids) == 0:
+        return
+    
+    xs = img.GetXAxis()
+    
+    # Pool each distinct m/z value once, then scatter it to all of its rows
+    rows = np.concatenate(feature_rows)[:, np.newaxis]
+    sources = np.repeat(np.arange(len(unique_centroids)), [len(r) for r in feature_rows])
+    lower = np.searchsorted(xs, unique_centroids - tolerance, side='left')
+    upper = np.searchsorted(xs, unique_centroids + tolerance, side='right')
+    windows = [(j, lo, hi) for j, (lo, hi) in enumerate(zip(lower, upper)) if hi > lo]
+    
+    n_spectra = img.GetNumberOfSpectra()
+    positions = np.array([img.GetSpectrumPosition(k) for k in range(n_spectra)])
+    batch_size = max(1, batch_bytes // (4 * len(xs)))
+    
+    # Report progress at most ~100 times
+    n_batches = -(-n_spectra // batch_size)
+    progress_step = max(1, n_batches // 100)
+    
+    for n_done, start in enumerate(range(0, n_spectra, batch_size), start=1):
+        stop = min(start + batch_size, n_spectra)
+        spectra = img.GetSpectra(list(range(start, stop)))
+        
+        # Pool the intensities of every centroid window for this batch of pixels
+        pooled = np.zeros((len(unique_centroids), stop - start), dtype=np.float32)
+        for j, lo, hi in windows:
+            pooled[j] = spectra[:, lo:hi].max(axis=1)
+        
+        batch_positions = positions[start:stop]
+        data_matrix[rows, batch_positions[:, 1], batch_positions[:, 0]] = pooled[sources]
+        if n_done % progress_step == 0 or n_done == n_batches:
+            print(f"  Processed {stop}/{n_spectra} spectra")
+
+
+def _write_transposed(data_matrix, dest, stripe_bytes=64 * 1024**2):
+    """
+    Copy data_matrix [n_features, height, width] into dest [height, width, n_features]
+    in stripes of image rows, so that only one stripe is transposed at a time.
+    """
+    n_features, height, width = data_matrix.shape
+    stripe_rows = max(1, stripe_bytes // (4 * n_features * width))
+    for row in range(0, height, stripe_rows):
+        dest[row:row + stripe_rows] = data_matrix[:, row:row + stripe_rows].transpose(1, 2, 0)
+
+
+def _savez_transposed(data_matrix, output_path, shape, stripe_bytes=64 * 1024**2):
+    """
+    Save data_matrix [n_features, height, width] with the features moved to the last axis
+    as the C-ordered array 'data' of the given shape in a compressed .npz file.
+    Like _write_transposed, only one stripe of image rows is transposed at a time.
+    """
+    n_features, height, width = data_matrix.shape
+    header = {
+        'descr': np.lib.format.dtype_to_descr(data_matrix.dtype),
+        'fortran_order': False,
+        'shape': tuple(shape)
+    }
+    stripe_rows = max(1, stripe_bytes // (4 * n_features * width))
+    with zipfile.ZipFile(output_path, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        with zf.open('data.npy', mode='w', force_zip64=True) as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for row in range(0, height, stripe_rows):
+                stripe = data_matrix[:, row:row + stripe_rows].transpose(1, 2, 0)
+                f.write(np.ascontiguousarray(stripe).data)
+
+
+def _submit_write(writer_pool, write_slots, fn, *args, **kwargs):
+    """
+    Queue fn(*args, **kwargs) on the writer pool once one of the write_slots is free,
+    the slot is released when the write is done. Blocks while all slots are taken.
+    """
+    write_slots.acquire()
+    future = writer_pool.submit(fn, *args, **kwargs)
+    future.add_done_callback(lambda _: write_slots.release())
+    return future
+
+
+def _submit_nrrd_write(writer_pool, write_slots, sitk_image, output_path, mz, tolerance_str, source_str,
+                       compression_level=1):
+    """
+    Set the NRRD metadata of an ion image and queue it on the writer pool.
+    A compression_level of 0 writes the file uncompressed.
+    """
+    # Set metadata
+    sitk_image.SetMetaData('mz_value', str(float(mz)))
+    sitk_image.SetMetaData('tolerance_ppm', tolerance_str)
+    sitk_image.SetMetaData('source_file', source_str)
+    
+    # Write NRRD file using SimpleITK (gzip, fast level by default)
+    return _submit_write(
+        writer_pool, write_slots, sitk.WriteImage, sitk_image, str(output_path),
+        useCompression=compression_level > 0,
+        compressionLevel=compression_level if compression_level > 0 else -1
+    )
+
+
+def _write_zarr_image(zarr_array, rows, ion_image):
+    """
+    Write an ion image (numpy array or SimpleITK image) to its row(s)
+    of the [n_features, height, width] Zarr array.
+    """
+    if isinstance(ion_image, sitk.Image):
+        ion_image = sitk.GetArrayViewFromImage(ion_image)
+    ion_array = ion_image.reshape(ion_image.shape[-2:])
+    for row in rows:
+        zarr_array[row] = ion_array
+
+
+def _is_continuous_imzml(imzml_path):
+    """
+    Read the storage type of the spectra from the fileContent of the imzML header,
+    True for continuous and False for processed files. Stops parsing after the header.
+    """
+    with open(imzml_path, 'rb') as f:
+        for _, elem in ET.iterparse(f):
+            tag = elem.tag.rsplit('}', 1)[-1]
+            if tag == 'cvParam' and elem.get('accession') in ('IMS:1000030', 'IMS:1000031'):
+                return elem.get('accession') == 'IMS:1000030'
+            if tag == 'fileContent':
+                break
+    return False
 
 
 def main():
@@ -25,6 +240,9 @@ Examples:
   # Convert using specific m/z values
   python imzml_to_nrrd.py input.imzML --centroids 100.5 200.3 300.7
   
+  # Convert using m/z values listed in a text file
+  python imzml_to_nrrd.py input.imzML --centroids-file centroids.txt
+  
   # Save individual NRRD files
   python imzml_to_nrrd.py input.imzML --save-nrrd
   
@@ -37,8 +255,20 @@ Examples:
   # Save both formats
   python imzml_to_nrrd.py input.imzML --save-npy-spatial --save-npy-list
   
+  # Save compressed numpy arrays (.npz)
+  python imzml_to_nrrd.py input.imzML --save-npy-spatial --npy-compress
+  
+  # Save a single chunked Zarr store [n_features, height, width]
+  python imzml_to_nrrd.py input.imzML --save-zarr
+  
   # Specify output directory
   python imzml_to_nrrd.py input.imzML --output-dir ./output
+  
+  # Limit the number of worker threads
+  python imzml_to_nrrd.py input.imzML --save-nrrd --workers 4
+  
+  # Read every spectrum only once (continuous imzML, many centroids)
+  python imzml_to_nrrd.py input.imzML --save-npy-spatial --batch-spectra
         """
     )
     
@@ -48,7 +278,8 @@ Examples:
         help="Path to the input imzML file"
     )
     
-    parser.add_argument(
+    centroid_group = parser.add_mutually_exclusive_group()
+    centroid_group.add_argument(
         "--centroids",
         type=float,
         nargs='+',
@@ -56,6 +287,13 @@ Examples:
         help="List of m/z centroid values (if not provided, uses file's centroids)"
     )
     
+    centroid_group.add_argument(
+        "--centroids-file",
+        type=str,
+        default=None,
+        help="Text file with one m/z centroid value per line (lines starting with # are ignored)"
+    )
+    
     parser.add_argument(
         "--output-dir",
         type=str,
@@ -76,6 +314,15 @@ Examples:
         help="Save individual NRRD files for each m/z value"
     )
     
+    parser.add_argument(
+        "--nrrd-compression-level",
+        type=int,
+        choices=range(10),
+        default=1,
+        metavar="{0-9}",
+        help="gzip level for NRRD files, 1 is fastest and 9 smallest, 0 disables compression (default: 1)"
+    )
+    
     parser.add_argument(
         "--save-npy-spatial",
         action="store_true",
@@ -88,6 +335,18 @@ Examples:
         help="Save 2D numpy array [n_pixels, n_features] as flattened list"
     )
     
+    parser.add_argument(
+        "--save-zarr",
+        action="store_true",
+        help="Save a single chunked Zarr store [n_features, height, width] with one ion image per chunk"
+    )
+    
+    parser.add_argument(
+        "--npy-compress",
+        action="store_true",
+        help="Save the numpy arrays compressed as .npz (key 'data') instead of .npy"
+    )
+    
     parser.add_argument(
         "--npy-output",
         type=str,
@@ -95,8 +354,38 @@ Examples:
         help="Output filename for numpy array (default: <input>_data.npy)"
     )
     
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Maximum number of worker threads extracting ion images, every worker opens its own "
+             "reader, which reads the whole imzML file once, so one worker is used per "
+             f"{_IMAGES_PER_READER} m/z values (default: 1)"
+    )
+    
+    parser.add_argument(
+        "--batch-spectra",
+        action="store_true",
+        help="Extract all m/z values in a single pass over the spectra (continuous imzML only)"
+    )
+    
     args = parser.parse_args()
     
+    if args.workers < 1:
+        print("Error: --workers must be at least 1", file=sys.stderr)
+        sys.exit(1)
+    
+    # Check the Zarr dependency before the imzML file is loaded
+    if args.save_zarr:
+        try:
+            import zarr
+        except ImportError:
+            print("Error: --save-zarr requires the 'zarr' package (pip install 'zarr>=3')", file=sys.stderr)
+            sys.exit(1)
+        if int(zarr.__version__.split('.')[0]) < 3:
+            print(f"Error: --save-zarr requires zarr 3 or newer (found {zarr.__version__})", file=sys.stderr)
+            sys.exit(1)
+    
     # Validate input file
     imzml_path = Path(args.imzml_file)
     if not imzml_path.exists():
@@ -106,6 +395,61 @@ Examples:
     if imzml_path.suffix.lower() != '.imzml':
         print(f"Warning: Input file does not have .imzML extension", file=sys.stderr)
     
+    # The single pass reads whole spectra, which requires a continuous file.
+    # The type is taken from the imzML header, the reader is only created
+    # after the thread counts are pinned below.
+    continuous = False
+    if args.batch_spectra:
+        try:
+            continuous = _is_continuous_imzml(imzml_path)
+        except (OSError, ET.ParseError) as e:
+            print(f"Error reading imzML header: {e}", file=sys.stderr)
+            sys.exit(1)
+    use_batch = args.batch_spectra and continuous
+    
+    # Centroids given on the command line or in a file do not need the reader
+    centroids = None
+    if args.centroids:
+        centroids = np.fromiter(args.centroids, dtype=np.float64, count=len(args.centroids))
+        print(f"Using {len(centroids)} provided centroid values")
+    elif args.centroids_file:
+        try:
+            # An empty file is reported below instead of numpy's warning
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', message="loadtxt: input contained no data")
+                centroid_table = np.loadtxt(args.centroids_file, dtype=np.float64, ndmin=2)
+        except Exception as e:
+            print(f"Error reading centroids file '{args.centroids_file}': {e}", file=sys.stderr)
+            sys.exit(1)
+        if centroid_table.shape[1] != 1:
+            print(f"Error: Centroids file '{args.centroids_file}' has {centroid_table.shape[1]} columns, "
+                  "expected one m/z value per line", file=sys.stderr)
+            sys.exit(1)
+        centroids = centroid_table[:, 0]
+        if len(centroids) == 0:
+            print(f"Error: No centroids found in '{args.centroids_file}'", file=sys.stderr)
+            sys.exit(1)
+        print(f"Using {len(centroids)} centroid values from {args.centroids_file}")
+    
+    # Every worker loads its own reader, only use as many as the m/z values pay for.
+    # m/z values outside of the file's range are only known once the reader is
+    # loaded, they can lower the number of workers further below.
+    n_workers = args.workers
+    if centroids is not None:
+        n_workers = _plan_workers(n_workers, len(np.unique(centroids)))
+    
+    # The worker pool owns the cores, keep the libraries' own thread pools
+    # single-threaded to avoid oversubscription. Explicit environment settings
+    # are kept. m2aia loads its libraries (and OpenMP) when it is imported and
+    # they read these variables only then, so m2aia is imported afterwards.
+    if not use_batch and n_workers > 1:
+        os.environ.setdefault('OMP_NUM_THREADS', '1')
+        if 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS' not in os.environ:
+            os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = '1'
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    
+    import m2aia as m2
+    
     # Set output directory
     if args.output_dir:
         output_dir = Path(args.output_dir)
@@ -129,11 +473,8 @@ Examples:
     spectrum_type = img.GetSpectrumType()
     print(f"Spectrum type: {spectrum_type}")
     
-    # Determine which centroids to use
-    if args.centroids:
-        centroids = np.array(args.centroids, dtype=np.float32)
-        print(f"Using {len(centroids)} provided centroid values")
-    else:
+    # Without given centroids use the file's own centroids
+    if centroids is None:
         # Check if the file is centroid format
         if "Centroid" in str(spectrum_type):
             # Get centroids from the file's centroid list
@@ -142,11 +483,11 @@ Examples:
                 print(f"Using {len(centroids)} centroids from centroid imzML file")
             except Exception as e:
                 print(f"Error extracting centroids from file: {e}", file=sys.stderr)
-                print("Please provide centroids manually using --centroids", file=sys.stderr)
+                print("Please provide centroids manually using --centroids or --centroids-file", file=sys.stderr)
                 sys.exit(1)
         else:
             print(f"Error: File is not in centroid format ({spectrum_type})", file=sys.stderr)
-            print("Please provide centroids manually using --centroids", file=sys.stderr)
+            print("Please provide centroids manually using --centroids or --centroids-file", file=sys.stderr)
             sys.exit(1)
     
     if len(centroids) == 0:
@@ -156,93 +497,302 @@ Examples:
     # Set tolerance
     img.SetTolerance(args.tolerance)
     
+    # Extract each distinct m/z value once and in ascending order, which keeps
+    # the backend's lookups on the m/z axis local. The outputs keep the given
+    # order, feature_rows maps every distinct value to its output rows.
+    unique_centroids, feature_index = np.unique(centroids, return_inverse=True)
+    feature_rows = [[] for _ in unique_centroids]
+    for i, u in enumerate(feature_index):
+        feature_rows[u].append(i)
+    
+    # m2aia rejects m/z values outside of the m/z axis. Check them once up front
+    # instead of catching the errors per ion image, their rows stay zero.
+    x_axis = img.GetXAxis()
+    in_range = (unique_centroids >= x_axis.min()) & (unique_centroids <= x_axis.max())
+    if not in_range.all():
+        skipped = unique_centroids[~in_range]
+        print(f"Warning: Skipping {len(skipped)} m/z values outside of the m/z range "
+              f"[{x_axis.min():.4f}, {x_axis.max():.4f}]: "
+              + ", ".join(f"{mz:.4f}" for mz in skipped[:10])
+              + (", ..." if len(skipped) > 10 else ""), file=sys.stderr)
+        unique_centroids = unique_centroids[in_range]
+        feature_rows = [rows for rows, keep in zip(feature_rows, in_range) if keep]
+    
+    n_workers = _plan_workers(n_workers, len(unique_centroids))
+    
+    if args.batch_spectra and not use_batch:
+        print(f"Warning: --batch-spectra requires a continuous imzML file ({spectrum_type}), "
+              "extracting ion images one by one", file=sys.stderr)
+    
+    # Duplicate and out of range m/z values are not extracted, count the remaining ones
+    n_images = len(unique_centroids)
+    peaks_str = f"{len(centroids)} peaks"
+    if n_images != len(centroids):
+        peaks_str += f" ({n_images} to extract)"
+    
     print(f"Tolerance: {args.tolerance} ppm")
-    print(f"Processing {len(centroids)} peaks...")
+    if use_batch:
+        print(f"Processing {peaks_str} in a single pass over the spectra...")
+    else:
+        print(f"Processing {peaks_str} using {n_workers} worker threads...")
     
     # Initialize data matrix if numpy output is requested
-    data_matrix_3d = None
+    data_matrix = None
     data_matrix_2d = None
-    image_shape = None
-    
-    # Process each centroid
-    for i, mz in enumerate(centroids):
-        try:
-            # Get the ion image for this m/z value (returns ITK image)
-            itk_image = img.GetImage(mz, args.tolerance)
-            
-            # Convert ITK image to SimpleITK image
-            sitk_image = sitk.Cast(itk_image, sitk.sitkFloat32)
-            
-            # Initialize data matrix on first image if needed
-            if (args.save_npy_spatial or args.save_npy_list) and image_shape is None:
-                image_shape = sitk_image.GetSize()
-                data_matrix_3d = np.zeros((image_shape[1], image_shape[0], len(centroids)), dtype=np.float32)
-                print(f"Allocated 3D data matrix: {data_matrix_3d.shape} [height, width, n_features]")
-            
-            # Get numpy array for data matrix if requested
-            if data_matrix_3d is not None:
-                ion_array = sitk.GetArrayFromImage(sitk_image)
-                data_matrix_3d[:, :, i] = ion_array
-            
-            # Save NRRD file if requested
-            if args.save_nrrd:
-                # Generate output filename
-                output_filename = f"{imzml_path.stem}_mz_{mz:.4f}.nrrd"
-                output_path = output_dir / output_filename
-                
-                # Set metadata
-                sitk_image.SetMetaData('mz_value', str(float(mz)))
-                sitk_image.SetMetaData('tolerance_ppm', str(args.tolerance))
-                sitk_image.SetMetaData('source_file', str(imzml_path.name))
-                
-                # Write NRRD file using SimpleITK (with compression)
-                sitk.WriteImage(sitk_image, str(output_path), useCompression=True)
-            
-            if (i + 1) % 10 == 0 or (i + 1) == len(centroids):
-                print(f"  Processed {i + 1}/{len(centroids)}: m/z = {mz:.4f}")
-        except Exception as e:
-            print(f"Warning: Failed to process m/z {mz:.4f}: {str(e)}", file=sys.stderr)
-            continue
+    scratch_path = None
+    image_shape = tuple(int(n) for n in img.GetShape())
     
-    # Save numpy arrays if requested
     if args.save_npy_spatial or args.save_npy_list:
         # Determine output filename
         if args.npy_output:
             npy_base = output_dir / args.npy_output
         else:
             npy_base = output_dir / f"{imzml_path.stem}_data"
-        
-        if args.save_npy_spatial:
-            output_spatial = npy_base.parent / f"{npy_base.stem}_spatial.npy"
-            np.save(str(output_spatial), data_matrix_3d)
-            print(f"\nSpatial numpy array saved: {output_spatial}")
-            print(f"  Shape: {data_matrix_3d.shape} [height, width, n_features]")
-            print(f"  Size: {data_matrix_3d.nbytes / (1024**2):.2f} MB")
-        
-        if args.save_npy_list:
-            # Reshape to 2D: [height*width, n_features]
-            data_matrix_2d = data_matrix_3d.reshape(-1, len(centroids))
-            output_list = npy_base.parent / f"{npy_base.stem}_list.npy"
-            np.save(str(output_list), data_matrix_2d)
-            print(f"\nList numpy array saved: {output_list}")
-            print(f"  Shape: {data_matrix_2d.shape} [n_pixels, n_features]")
-            print(f"  Size: {data_matrix_2d.nbytes / (1024**2):.2f} MB")
-        
-        # Save metadata file with m/z values
-        metadata_file = npy_base.parent / f"{npy_base.stem}_metadata.npz"
-        np.savez(
-            str(metadata_file),
-            mz_values=centroids,
+    
+    # Create the Zarr store if requested, one compressed chunk per ion image
+    zarr_array = None
+    if args.save_zarr:
+        zarr_path = output_dir / f"{imzml_path.stem}.zarr"
+        zarr_group = zarr.open_group(str(zarr_path), mode='w')
+        zarr_array = zarr_group.create_array(
+            "intensities",
+            shape=(len(centroids), image_shape[1], image_shape[0]),
+            chunks=(1, image_shape[1], image_shape[0]),
+            dtype=np.float32,
+            fill_value=0,
+            compressors=zarr.codecs.BloscCodec(cname='zstd', clevel=3, shuffle='shuffle')
+        )
+        zarr_group.create_array("mz_values", data=centroids)
+        zarr_group.attrs.update(
             tolerance_ppm=args.tolerance,
-            image_width=image_shape[0] if image_shape else 0,
-            image_height=image_shape[1] if image_shape else 0,
+            image_width=image_shape[0],
+            image_height=image_shape[1],
+            axes="n_features,height,width",
             source_file=str(imzml_path.name)
         )
-        print(f"\nMetadata saved: {metadata_file}")
+    
+    # Everything that uses the scratch file runs in try, so that it is removed
+    # on errors and interruptions as well
+    try:
+        if args.save_npy_spatial or args.save_npy_list or use_batch:
+            # Back the data matrix by a file next to the outputs, so that its size
+            # is not limited by the available RAM. The file starts out zero-filled,
+            # failed m/z values are left as zeros.
+            # Features come first so that every ion image is one contiguous block.
+            scratch_fd, scratch_name = tempfile.mkstemp(
+                prefix=f"{imzml_path.stem}_", suffix=".scratch.npy", dir=output_dir
+            )
+            os.close(scratch_fd)
+            scratch_path = Path(scratch_name)
+            data_matrix = np.lib.format.open_memmap(
+                str(scratch_path), mode='w+', dtype=np.float32,
+                shape=(len(centroids), image_shape[1], image_shape[0])
+            )
+            print(f"Allocated data matrix: {data_matrix.shape} [n_features, height, width] ({scratch_path})")
+        
+        # NRRD files and Zarr chunks are compressed and written on a separate pool,
+        # so that extraction of the next ion images does not wait for disk I/O.
+        # The number of queued writes is bounded, every one holds an ion image.
+        writer_threads = min(4, os.cpu_count() or 1)
+        writer_pool = ThreadPoolExecutor(max_workers=writer_threads)
+        write_slots = threading.Semaphore(2 * writer_threads)
+        write_futures = {}
+        
+        # NRRD metadata that is the same for every m/z value
+        tolerance_str = str(args.tolerance)
+        source_str = str(imzml_path.name)
+        
+        # Generate all NRRD output filenames up front
+        nrrd_paths = None
+        if args.save_nrrd:
+            stem = imzml_path.stem
+            nrrd_paths = [output_dir / f"{stem}_mz_{mz:.4f}.nrrd" for mz in unique_centroids.tolist()]
+        
+        if use_batch:
+            try:
+                _batch_ion_images(img, unique_centroids, feature_rows, args.tolerance, data_matrix)
+            except Exception as e:
+                print(f"Error extracting ion images: {e}", file=sys.stderr)
+                sys.exit(1)
+            
+            # Save NRRD files and Zarr chunks if requested
+            spacing = img.GetSpacing()
+            origin = img.GetOrigin()
+            for u, (rows, mz) in enumerate(zip(feature_rows, unique_centroids)):
+                if args.save_nrrd:
+                    # Use the geometry of the reader, as GetImage does
+                    sitk_image = sitk.GetImageFromArray(data_matrix[rows[0]][np.newaxis])
+                    sitk_image.SetSpacing(spacing)
+                    sitk_image.SetOrigin(origin)
+                    
+                    future = _submit_nrrd_write(
+                        writer_pool, write_slots, sitk_image, nrrd_paths[u], mz, tolerance_str, source_str,
+                        args.nrrd_compression_level
+                    )
+                    write_futures[future] = f"NRRD file for m/z {mz:.4f}"
+                
+                if zarr_array is not None:
+                    future = _submit_write(
+                        writer_pool, write_slots, _write_zarr_image, zarr_array, rows, data_matrix[rows[0]]
+                    )
+                    write_futures[future] = f"Zarr chunk for m/z {mz:.4f}"
+        else:
+            # Extract the ion images in parallel, each worker thread uses its own reader
+            extraction_done = threading.Event()
+            executor = ThreadPoolExecutor(
+                max_workers=n_workers,
+                initializer=_init_worker,
+                initargs=(str(imzml_path), args.tolerance, [img], extraction_done)
+            )
+            try:
+                # SimpleITK images are only needed for NRRD files, all other outputs
+                # take the numpy arrays of m2aia directly
+                extract = _extract_ion_image if args.save_nrrd else _extract_ion_array
+                
+                # Prefetch a bounded number of ion images, so finished images do not
+                # pile up in memory when copying falls behind. Together with the
+                # bounded write queue this also holds when writing falls behind.
+                completed = _completed_in_window(
+                    executor,
+                    partial(extract, tolerance=args.tolerance),
+                    unique_centroids.tolist(),
+                    max_pending=2 * n_workers
+                )
+                
+                # Report progress every 10 images, but at most ~100 times
+                progress_step = max(10, n_images // 100)
+                
+                # Collect the ion images as they complete
+                failed = []
+                for n_done, (u, future) in enumerate(completed, start=1):
+                    mz = unique_centroids[u]
+                    error = future.exception()
+                    if error is not None:
+                        # Reported after the loop, the rows of this m/z value stay zero
+                        failed.append((mz, error))
+                    else:
+                        ion_image = future.result()
+                        if args.save_nrrd:
+                            sitk_image = ion_image
+                            ion_array = sitk.GetArrayViewFromImage(sitk_image)
+                        else:
+                            ion_array = ion_image
+                        
+                        # Copy the ion image straight into its row(s) of the data matrix (no intermediate array)
+                        if data_matrix is not None:
+                            data_matrix[feature_rows[u]] = ion_array
+                        
+                        # Save NRRD file if requested
+                        if args.save_nrrd:
+                            write_future = _submit_nrrd_write(
+                                writer_pool, write_slots, sitk_image, nrrd_paths[u], mz, tolerance_str, source_str,
+                                args.nrrd_compression_level
+                            )
+                            write_futures[write_future] = f"NRRD file for m/z {mz:.4f}"
+                        
+                        # Save Zarr chunk(s) if requested
+                        if zarr_array is not None:
+                            write_future = _submit_write(
+                                writer_pool, write_slots, _write_zarr_image, zarr_array, feature_rows[u], ion_image
+                            )
+                            write_futures[write_future] = f"Zarr chunk for m/z {mz:.4f}"
+                    
+                    if n_done % progress_step == 0 or n_done == n_images:
+                        print(f"  Processed {n_done}/{n_images}: m/z = {mz:.4f}")
+            finally:
+                # Do not wait for a reader that is still loading after all ion images are done,
+                # it is released in the background and the threads waiting for one open none
+                extraction_done.set()
+                executor.shutdown(wait=False)
+            
+            for mz, error in failed:
+                print(f"Warning: Failed to process m/z {mz:.4f}: {str(error)}", file=sys.stderr)
+        
+        # Wait for the pending NRRD and Zarr writes
+        for future in as_completed(write_futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Warning: Failed to write {write_futures[future]}: {str(e)}", file=sys.stderr)
+        writer_pool.shutdown()
+        
+        # Save numpy arrays if requested
+        if args.save_npy_spatial or args.save_npy_list:
+            if args.save_npy_spatial:
+                # Move features to the last axis: [height, width, n_features]
+                data_matrix_3d = data_matrix.transpose(1, 2, 0)
+                if args.npy_compress:
+                    # np.savez_compressed streams the view in chunks, no full copy
+                    output_spatial = npy_base.parent / f"{npy_base.stem}_spatial.npz"
+                    np.savez_compressed(str(output_spatial), data=data_matrix_3d)
+                else:
+                    output_spatial = npy_base.parent / f"{npy_base.stem}_spatial.npy"
+                    data_matrix_3d = np.lib.format.open_memmap(
+                        str(output_spatial), mode='w+', dtype=np.float32,
+                        shape=(image_shape[1], image_shape[0], len(centroids))
+                    )
+                    _write_transposed(data_matrix, data_matrix_3d)
+                    data_matrix_3d.flush()
+                print(f"\nSpatial numpy array saved: {output_spatial}")
+                print(f"  Shape: {data_matrix_3d.shape} [height, width, n_features]")
+                print(f"  Size: {data_matrix_3d.nbytes / (1024**2):.2f} MB")
+                if args.npy_compress:
+                    print(f"  Compressed size: {output_spatial.stat().st_size / (1024**2):.2f} MB")
+            
+            if args.save_npy_list:
+                # Reshape to 2D: [height*width, n_features]
+                if args.npy_compress:
+                    output_list = npy_base.parent / f"{npy_base.stem}_list.npz"
+                    data_matrix_2d = data_matrix.reshape(len(centroids), -1).T
+                    _savez_transposed(data_matrix, output_list, data_matrix_2d.shape)
+                else:
+                    output_list = npy_base.parent / f"{npy_base.stem}_list.npy"
+                    data_matrix_2d = np.lib.format.open_memmap(
+                        str(output_list), mode='w+', dtype=np.float32,
+                        shape=(image_shape[1] * image_shape[0], len(centroids))
+                    )
+                    if args.save_npy_spatial:
+                        # The spatial array already has the list layout in memory,
+                        # reshaping it is a free view and the copy stays sequential
+                        data_matrix_2d[...] = data_matrix_3d.reshape(-1, len(centroids))
+                    else:
+                        _write_transposed(
+                            data_matrix, data_matrix_2d.reshape(image_shape[1], image_shape[0], len(centroids))
+                        )
+                    data_matrix_2d.flush()
+                print(f"\nList numpy array saved: {output_list}")
+                print(f"  Shape: {data_matrix_2d.shape} [n_pixels, n_features]")
+                print(f"  Size: {data_matrix_2d.nbytes / (1024**2):.2f} MB")
+                if args.npy_compress:
+                    print(f"  Compressed size: {output_list.stat().st_size / (1024**2):.2f} MB")
+            
+            # Save metadata file with m/z values
+            metadata_file = npy_base.parent / f"{npy_base.stem}_metadata.json"
+            metadata = {
+                'mz_values': centroids.tolist(),
+                'tolerance_ppm': args.tolerance,
+                'image_width': int(image_shape[0]),
+                'image_height': int(image_shape[1]),
+                'spatial_axes': "height,width,n_features",
+                'list_axes': "n_pixels,n_features",
+                'source_file': str(imzml_path.name)
+            }
+            with open(metadata_file, 'w') as f:
+                json.dump(metadata, f, indent=2)
+            print(f"\nMetadata saved: {metadata_file}")
+    finally:
+        # Release the memory map and remove the scratch file
+        if scratch_path is not None:
+            del data_matrix
+            scratch_path.unlink()
     
     if args.save_nrrd:
         print(f"\nNRRD files saved to: {output_dir}")
     
+    if args.save_zarr:
+        print(f"\nZarr store saved: {zarr_path}")
+        print(f"  Shape: {zarr_array.shape} [n_features, height, width]")
+    
     print(f"\nConversion complete!")
 
 